@@ -4,11 +4,13 @@
 
 # COMMAND ----------
 
-from collections import defaultdict
+import os
+from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import numpy as np
+from ortools.sat import cp_model_pb2
 from ortools.sat.python import cp_model
 from pydantic import BaseModel
 
@@ -20,11 +22,13 @@ from pydantic import BaseModel
 # COMMAND ----------
 
 
-class Stand(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Stand:
     stand_id: str
 
 
-class Turn(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Turn:
     turn_id: str
     turn_seq: int
     flight_id: str
@@ -75,6 +79,57 @@ feasibility[3][4] = False
 
 feasibility
 
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Helper function to add optional intervals in bulk
+# MAGIC + All of our intervals have fixed start and end times, so they can be written straight into the model's protobuf as
+# MAGIC interval constraints enforced by their presence literal, in a single batch
+# MAGIC + This skips the per-interval expression parsing and `IntervalVar` wrapper of `NewOptionalIntervalVar`: intervals
+# MAGIC are referred to by their constraint index in the model proto instead
+
+# COMMAND ----------
+
+
+def add_optional_intervals(
+    model: cp_model.CpModel,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    presence_literals: list[int],
+    names: list[str],
+) -> np.ndarray:
+    """
+    Append fixed-time optional intervals to the model proto in a single batch.
+
+    Args:
+        model: The CP-SAT model
+        starts: Start time of each interval
+        ends: End time of each interval
+        presence_literals: Index of the presence literal enforcing each interval
+        names: Name of each interval
+
+    Returns:
+        The constraint indices of the new intervals in the model proto
+    """
+    constraints = model.Proto().constraints
+    first_index = len(constraints)
+    constraints.extend(
+        cp_model_pb2.ConstraintProto(
+            name=name,
+            enforcement_literal=[literal],
+            interval=cp_model_pb2.IntervalConstraintProto(
+                start=cp_model_pb2.LinearExpressionProto(offset=start),
+                size=cp_model_pb2.LinearExpressionProto(offset=end - start),
+                end=cp_model_pb2.LinearExpressionProto(offset=end),
+            ),
+        )
+        for start, end, literal, name in zip(
+            starts.tolist(), ends.tolist(), presence_literals, names
+        )
+    )
+    return np.arange(first_index, len(constraints), dtype=np.int32)
+
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -88,45 +143,92 @@ feasibility
 model = cp_model.CpModel()
 
 stand_indices: dict[str, int] = {stand.stand_id: i for i, stand in enumerate(stands)}
-intervals_per_stand: defaultdict[str, list[cp_model.IntervalVar]] = defaultdict(list)
-presence_vars_per_flight: defaultdict[str, list[cp_model.BoolVarT]] = defaultdict(list)
-assignments: defaultdict[
-    tuple[str, str], dict[str, cp_model.BoolVarT | cp_model.IntervalVar]
-] = defaultdict(dict)
+turn_arr: np.ndarray = np.fromiter(
+    (turn.arrival_time for turn in turns), dtype=np.int32, count=len(turns)
+)
+turn_dep: np.ndarray = np.fromiter(
+    (turn.departure_time for turn in turns), dtype=np.int32, count=len(turns)
+)
+
+# Structure-of-arrays view of the assignment variables, indexed by [t_idx, s_idx]
+# and only populated where `feasibility` is True: `intervals` holds the constraint
+# index of each main interval in the model proto
+presence: np.ndarray = np.empty((len(turns), len(stands)), dtype=object)
+intervals: np.ndarray = np.full((len(turns), len(stands)), -1, dtype=np.int32)
+
+# Feasible assignments in creation order, used to report the solution
+assignment_list: list[tuple[Turn, Stand, cp_model.BoolVarT]] = []
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC Here we iterate over all turns and stands, and create the variables for the (feasible) assignments
+# MAGIC Here we iterate over all turns and their feasible stands, and create the presence variables for the assignments
+# MAGIC + Each row of the feasibility matrix is packed into an integer bitmask, so only the set bits (feasible stands) are
+# MAGIC visited and infeasible cells cost nothing
+# MAGIC + Each turn's exactly-one constraint is built as soon as its row of presence variables is complete, and these
+# MAGIC constraints are appended to the model proto in a single batch rather than through one `AddExactlyOne` call per turn
+# MAGIC + The main intervals of all the assignments are then added in one batch
 
 # COMMAND ----------
 
+feasible_stand_masks: list[int] = [
+    int.from_bytes(row.tobytes(), "little")
+    for row in np.packbits(feasibility, axis=1, bitorder="little")
+]
+
+# Flat (t_idx, s_idx, presence literal) of each assignment, appended together alongside
+# assignment_list so the batched main intervals line up with their literals and names
+assignment_t_idxs: list[int] = []
+assignment_s_idxs: list[int] = []
+presence_literals: list[int] = []
+exactly_one_constraints: list[cp_model_pb2.ConstraintProto] = []
+
 for t_idx, turn in enumerate(turns):
-    for s_idx, stand in enumerate(stands):
-        if not feasibility[t_idx][s_idx]:
-            continue
+    row_literals: list[int] = []
+    mask = feasible_stand_masks[t_idx]
+    while mask:
+        s_idx = (mask & -mask).bit_length() - 1
+        mask &= mask - 1
+        stand = stands[s_idx]
         is_present: cp_model.BoolVarT = model.NewBoolVar(
             f"{turn.turn_id}_on_{stand.stand_id}"
         )
-        var = model.NewOptionalIntervalVar(
-            turn.arrival_time,
-            turn.departure_time - turn.arrival_time,
-            turn.departure_time,
-            is_present,
-            name=f"stand_{stand.stand_id}_for_{turn.turn_id}",
+        presence[t_idx, s_idx] = is_present
+        assignment_list.append((turn, stand, is_present))
+        row_literals.append(is_present.Index())
+        assignment_t_idxs.append(t_idx)
+        assignment_s_idxs.append(s_idx)
+        presence_literals.append(is_present.Index())
+    if row_literals:
+        exactly_one_constraints.append(
+            cp_model_pb2.ConstraintProto(
+                exactly_one=cp_model_pb2.BoolArgumentProto(literals=row_literals)
+            )
         )
-        intervals_per_stand[stand.stand_id].append(var)
-        presence_vars_per_flight[turn.turn_id].append(is_present)
-        assignments[(turn.turn_id, stand.stand_id)] = {
-            "is_present": is_present,
-            "interval": var,
-        }
 
-for f_id, bool_vars in presence_vars_per_flight.items():
-    model.AddExactlyOne(bool_vars)
+model.Proto().constraints.extend(exactly_one_constraints)
+
+intervals[assignment_t_idxs, assignment_s_idxs] = add_optional_intervals(
+    model,
+    turn_arr[assignment_t_idxs],
+    turn_dep[assignment_t_idxs],
+    presence_literals,
+    [
+        f"stand_{stand.stand_id}_for_{turn.turn_id}"
+        for turn, stand, _ in assignment_list
+    ],
+)
+
+# Feasible turn indices on each stand, so each adjacency rule only visits the turns on its two stands
+turn_indices_per_stand: list[np.ndarray] = [
+    np.flatnonzero(feasibility[:, s_idx]) for s_idx in range(len(stands))
+]
 
-for stand, intervals in intervals_per_stand.items():
-    model.AddNoOverlap(intervals)
+# Group the intervals per stand by masking the array, rather than appending to the groups
+# one variable at a time. The groups are indexed by s_idx
+intervals_per_stand: list[np.ndarray] = [
+    intervals[t_idxs, s_idx] for s_idx, t_idxs in enumerate(turn_indices_per_stand)
+]
 
 
 # COMMAND ----------
@@ -172,31 +274,129 @@ class AdjacencyRule(BaseModel):
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Helper function to compute the shadow interval times
-# MAGIC + This function is used to compute the shadow interval times for a given turn and time window definition
+# MAGIC ### Helper functions to compute the shadow interval times
+# MAGIC + The anchors and offsets of a time window definition are fixed per rule, so they are resolved once into integer
+# MAGIC coefficients of the arrival and departure times
+# MAGIC + These coefficients are then used to compute the shadow interval times for the turns on a stand
+# MAGIC + The Pydantic rule models are only used to load and validate the rules: each rule is resolved once into a plain
+# MAGIC named tuple of its stands and coefficients before building the model
 
 # COMMAND ----------
 
+ShadowCoefficients = tuple[int, int, int, int, int, int]
+
+# A window of (ARRIVAL + 0, DEPARTURE + 0) reproduces the main interval of the turn
+IDENTITY_COEFFICIENTS: ShadowCoefficients = (1, 0, 0, 0, 1, 0)
+
+
+def _shadow_coefficients(time_constraint: TimeWindowDefinition) -> ShadowCoefficients:
+    """Resolve a TimeWindowDefinition into linear coefficients of (arrival, departure).
+
+    Returns (start_arr, start_dep, start_offset, end_arr, end_dep, end_offset) such that
+    `start = start_arr * arr + start_dep * dep + start_offset`, and likewise for the end.
+    """
+    start_is_arr = time_constraint.start_anchor == TimeAnchor.ARRIVAL
+    end_is_arr = time_constraint.end_anchor == TimeAnchor.ARRIVAL
+    return (
+        int(start_is_arr),
+        int(not start_is_arr),
+        time_constraint.start_offset_minutes,
+        int(end_is_arr),
+        int(not end_is_arr),
+        time_constraint.end_offset_minutes,
+    )
+
+
+class ResolvedAdjacencyRule(NamedTuple):
+    """An AdjacencyRule with its time windows resolved into shadow coefficients."""
+
+    name: str
+    stand_a: str
+    stand_b: str
+    coefficients_a: ShadowCoefficients
+    coefficients_b: ShadowCoefficients
 
-def _compute_shadow_times(
-    arr: int, dep: int, time_constraint: TimeWindowDefinition
-) -> tuple[int, int]:
-    """Compute shadow interval start and end times based on a TimeWindowDefinition."""
-    base_start = arr if time_constraint.start_anchor == TimeAnchor.ARRIVAL else dep
-    s_start = base_start + time_constraint.start_offset_minutes
 
-    base_end = arr if time_constraint.end_anchor == TimeAnchor.ARRIVAL else dep
-    s_end = base_end + time_constraint.end_offset_minutes
+def _resolve_rule(rule: AdjacencyRule) -> ResolvedAdjacencyRule:
+    """Convert a validated AdjacencyRule into a ResolvedAdjacencyRule."""
+    return ResolvedAdjacencyRule(
+        name=rule.name,
+        stand_a=rule.stand_a,
+        stand_b=rule.stand_b,
+        coefficients_a=_shadow_coefficients(rule.time_constraint_a),
+        coefficients_b=_shadow_coefficients(rule.time_constraint_b),
+    )
 
+
+def _compute_shadow_times(
+    arr: np.ndarray, dep: np.ndarray, coefficients: ShadowCoefficients
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute shadow interval start and end times from resolved shadow coefficients.
+
+    `arr` and `dep` are arrays of arrival and departure times, so the shadow times
+    for every turn on a stand are computed in one go.
+    """
+    start_arr, start_dep, start_offset, end_arr, end_dep, end_offset = coefficients
+    s_start = start_arr * arr + start_dep * dep + start_offset
+    s_end = end_arr * arr + end_dep * dep + end_offset
     return s_start, s_end
 
 
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Helper function to add no-overlap constraints in independent chains
+# MAGIC + All of our intervals have fixed start and end times, so two intervals can only overlap if their time ranges do
+# MAGIC + Sorting the intervals by start time, a new chain begins wherever an interval starts at or after the latest end
+# MAGIC seen so far: nothing before that point can overlap anything after it
+# MAGIC + Each chain gets its own (smaller) no-overlap constraint, which the solver propagates independently
+
+# COMMAND ----------
+
+
+def add_no_overlap_chains(
+    model: cp_model.CpModel,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    intervals: np.ndarray,
+) -> None:
+    """
+    Add NoOverlap constraints over fixed-time intervals, split into independent chains.
+
+    Args:
+        model: The CP-SAT model
+        starts: Start time of each interval
+        ends: End time of each interval
+        intervals: Constraint indices of the intervals, aligned with starts and ends
+    """
+    order = np.argsort(starts, kind="stable")
+    sorted_starts = starts[order]
+    latest_ends = np.maximum.accumulate(ends[order])
+    breaks = np.flatnonzero(sorted_starts[1:] >= latest_ends[:-1]) + 1
+
+    model.Proto().constraints.extend(
+        cp_model_pb2.ConstraintProto(
+            no_overlap=cp_model_pb2.NoOverlapConstraintProto(
+                intervals=intervals[chain].tolist()
+            )
+        )
+        for chain in np.split(order, breaks)
+        if len(chain) > 1
+    )
+
+
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC ## Apply the adjacency rules
 # MAGIC + This function is used to create a new set of interval variables for each adjacency rule
 # MAGIC + These are then added to the model as no-overlap constraints
+# MAGIC + Where a time window matches the turn itself, the main interval is reused rather than creating a duplicate
+# MAGIC + The function returns the stands whose main intervals are all part of a rule's no-overlap constraint, as these
+# MAGIC do not need a separate per-stand no-overlap constraint
+# MAGIC + Where the shadows of a rule are wider than, and contain, the turns' main intervals, a redundant cumulative
+# MAGIC constraint (capacity 1) over the main intervals of both stands is also added, stating the implied exclusion
+# MAGIC directly on the main intervals. CP-SAT's presolve may turn it into a no-overlap constraint
 
 # COMMAND ----------
 
@@ -204,53 +404,112 @@ def _compute_shadow_times(
 def apply_adjacency_rules(
     model: cp_model.CpModel,
     turns: list[Turn],
-    assignments: dict[
-        tuple[str, str], dict[str, cp_model.BoolVarT | cp_model.IntervalVar]
-    ],
+    stand_indices: dict[str, int],
+    turn_indices_per_stand: list[np.ndarray],
+    presence: np.ndarray,
+    intervals: np.ndarray,
+    turn_arr: np.ndarray,
+    turn_dep: np.ndarray,
     adjacency_rules: list[AdjacencyRule],
-) -> None:
+) -> set[int]:
     """
     Apply adjacency rules by creating shadow intervals that cannot overlap.
 
     Args:
         model: The CP-SAT model
         turns: List of Turn objects
-        assignments: Dict mapping (turn_id, stand_id) to assignment variables from main model
+        stand_indices: Dict mapping stand_id to its column in the feasibility matrix
+        turn_indices_per_stand: Indices of the turns feasible on each stand, indexed by s_idx
+        presence: Matrix of presence variables from the main model, indexed by [t_idx, s_idx]
+        intervals: Matrix of main interval constraint indices, indexed by [t_idx, s_idx]
+        turn_arr: Arrival time of each turn
+        turn_dep: Departure time of each turn
         adjacency_rules: List of AdjacencyRule objects defining the constraints
+
+    Returns:
+        The indices of the stands whose main intervals are covered by a rule's NoOverlap constraint
+
+    Raises:
+        ValueError: If a rule's time window gives a shadow interval with negative size
     """
-    turn_times = {
-        turn.turn_id: (turn.arrival_time, turn.departure_time) for turn in turns
-    }
-
-    for rule in adjacency_rules:
-        shadows = []
-
-        for (t_id, s_id), assignment in assignments.items():
-            if s_id == rule.stand_a:
-                arr, dep = turn_times[t_id]
-                s_start, s_end = _compute_shadow_times(arr, dep, rule.time_constraint_a)
-                shadow_interval = model.NewOptionalIntervalVar(
-                    start=s_start,
-                    size=(s_end - s_start),
-                    end=s_end,
-                    is_present=assignment["is_present"],
-                    name=f"Shadow_{rule.name}_{t_id}_{s_id}",
+    covered_stands: set[int] = set()
+
+    for rule in map(_resolve_rule, adjacency_rules):
+        sides = [(rule.stand_a, rule.coefficients_a)]
+        if rule.stand_b != rule.stand_a:
+            sides.append((rule.stand_b, rule.coefficients_b))
+        sides = [(s_id, c) for s_id, c in sides if s_id in stand_indices]
+
+        shadows: list[np.ndarray] = []
+        shadow_starts: list[np.ndarray] = []
+        shadow_ends: list[np.ndarray] = []
+        main_intervals: list[np.ndarray] = []
+        shadows_contain_main = True
+        all_identity = True
+
+        for s_id, coefficients in sides:
+            s_idx = stand_indices[s_id]
+            t_idxs = turn_indices_per_stand[s_idx]
+            s_starts, s_ends = _compute_shadow_times(
+                turn_arr[t_idxs], turn_dep[t_idxs], coefficients
+            )
+            if (s_ends < s_starts).any():
+                raise ValueError(
+                    f"Rule {rule.name} gives a shadow interval on stand {s_id} "
+                    "that ends before it starts"
                 )
-                shadows.append(shadow_interval)
-            elif s_id == rule.stand_b:
-                arr, dep = turn_times[t_id]
-                s_start, s_end = _compute_shadow_times(arr, dep, rule.time_constraint_b)
-                shadow_interval = model.NewOptionalIntervalVar(
-                    start=s_start,
-                    size=(s_end - s_start),
-                    end=s_end,
-                    is_present=assignment["is_present"],
-                    name=f"Shadow_{rule.name}_{t_id}_{s_id}",
+            shadow_starts.append(s_starts)
+            shadow_ends.append(s_ends)
+            side_intervals = intervals[t_idxs, s_idx]
+            main_intervals.append(side_intervals)
+            shadows_contain_main &= bool(
+                (s_starts <= turn_arr[t_idxs]).all()
+                and (s_ends >= turn_dep[t_idxs]).all()
+            )
+            all_identity &= coefficients == IDENTITY_COEFFICIENTS
+            if coefficients == IDENTITY_COEFFICIENTS:
+                shadows.append(side_intervals)
+                covered_stands.add(s_idx)
+                continue
+            shadows.append(
+                add_optional_intervals(
+                    model,
+                    s_starts,
+                    s_ends,
+                    [is_present.Index() for is_present in presence[t_idxs, s_idx]],
+                    [
+                        f"Shadow_{rule.name}_{turns[t_idx].turn_id}_{s_id}"
+                        for t_idx in t_idxs.tolist()
+                    ],
                 )
-                shadows.append(shadow_interval)
+            )
 
         if shadows:
-            model.AddNoOverlap(shadows)
+            add_no_overlap_chains(
+                model,
+                np.concatenate(shadow_starts),
+                np.concatenate(shadow_ends),
+                np.concatenate(shadows),
+            )
+
+        # When every shadow contains its turn's main interval, the main intervals of the
+        # two stands cannot overlap either, and this redundant cumulative states that on
+        # the main intervals directly. With identity windows on every side it would just
+        # repeat the rule's no-overlap over the same intervals, so it is skipped
+        if len(sides) > 1 and shadows_contain_main and not all_identity:
+            rule_main_intervals = np.concatenate(main_intervals).tolist()
+            unit = cp_model_pb2.LinearExpressionProto(offset=1)
+            model.Proto().constraints.append(
+                cp_model_pb2.ConstraintProto(
+                    cumulative=cp_model_pb2.CumulativeConstraintProto(
+                        capacity=unit,
+                        intervals=rule_main_intervals,
+                        demands=[unit] * len(rule_main_intervals),
+                    )
+                )
+            )
+
+    return covered_stands
 
 
 # COMMAND ----------
@@ -304,31 +563,73 @@ adjacency_rules: list[AdjacencyRule] = [
 
 # COMMAND ----------
 
-apply_adjacency_rules(model, turns, assignments, adjacency_rules)
+stands_covered_by_rules = apply_adjacency_rules(
+    model,
+    turns,
+    stand_indices,
+    turn_indices_per_stand,
+    presence,
+    intervals,
+    turn_arr,
+    turn_dep,
+    adjacency_rules,
+)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Per-stand no-overlap constraints
+# MAGIC + Each stand gets no-overlap constraints over its main intervals, split into independent chains
+# MAGIC + Stands already covered by an adjacency rule are skipped: that rule's no-overlap constraint contains all of the
+# MAGIC stand's main intervals, so a second constraint over them would be redundant
+
+# COMMAND ----------
+
+for s_idx, stand_intervals in enumerate(intervals_per_stand):
+    if len(stand_intervals) and s_idx not in stands_covered_by_rules:
+        t_idxs = turn_indices_per_stand[s_idx]
+        add_no_overlap_chains(
+            model, turn_arr[t_idxs], turn_dep[t_idxs], stand_intervals
+        )
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC ## Solve the model
 # MAGIC + Now we can use the CP-SAT solver to find a feasible solution
+# MAGIC + The solver runs its portfolio of search workers in parallel, one per available core
+# MAGIC + The random seed is fixed so that runs can be replayed, and the search log is printed for visibility
+# MAGIC + All our intervals have fixed start and end times, so a no-overlap conflict is just two present intervals whose
+# MAGIC times intersect: the heavier scheduling propagators (edge-finding, overload checking, precedence reasoning) cannot
+# MAGIC tighten anything, so we switch them off to save their cost at every backtrack
+# MAGIC + Core-based search settings are pinned rather than left to the defaults of the installed OR-Tools release, as
+# MAGIC these defaults have changed between releases and caused large slowdowns on some problems: core minimization is
+# MAGIC kept at the cheaper level 1, and core-based optimization stays off since the model has no objective to optimize
+# MAGIC + Re-check these settings when upgrading the `ortools` pin in `requirements.txt`
 
 # COMMAND ----------
 
 solver = cp_model.CpSolver()
+solver.parameters.num_workers = os.cpu_count() or 8
+solver.parameters.linearization_level = 1
+solver.parameters.random_seed = 1
+solver.parameters.log_search_progress = True
+solver.parameters.use_overload_checker_in_cumulative = False
+solver.parameters.use_timetable_edge_finding_in_cumulative = False
+solver.parameters.use_strong_propagation_in_disjunctive = False
+solver.parameters.use_precedences_in_disjunctive_constraint = False
+solver.parameters.core_minimization_level = 1
+solver.parameters.optimize_with_core = False
 status = solver.solve(model)
 
 if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
     print("Solution Found!")
 
-    for turn in turns:
-        for stand in stands:
-            if (turn.turn_id, stand.stand_id) in assignments:
-                if solver.Value(
-                    assignments[(turn.turn_id, stand.stand_id)]["is_present"]
-                ):
-                    print(
-                        f"  Turn {turn.turn_id} (Flight {turn.flight_id}) assigned to -> Stand {stand.stand_id}"
-                    )
+    for turn, stand, is_present in assignment_list:
+        if solver.Value(is_present):
+            print(
+                f"  Turn {turn.turn_id} (Flight {turn.flight_id}) assigned to -> Stand {stand.stand_id}"
+            )
 
 elif status == cp_model.INFEASIBLE:
     print("No solution found. The model is infeasible.")